@@ -1,22 +1,31 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
+import json
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Literal
 import uuid
 from datetime import datetime, timedelta
 import jwt
+import requests
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import secrets
 import hashlib
+import random
+import time
+from collections import OrderedDict
 
 
 ROOT_DIR = Path(__file__).parent
@@ -29,6 +38,16 @@ db = None
 # Security
 security = HTTPBearer()
 SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', '10000'))
+TOKEN_REVOCATION_REFRESH_SECONDS = int(os.environ.get('TOKEN_REVOCATION_REFRESH_SECONDS', '60'))
+# Verified JWT payloads by token, so repeat requests skip the HS256 decode
+verified_tokens: "OrderedDict[str, dict]" = OrderedDict()
+# user_id -> current token_version; tokens issued with an older version are revoked
+revoked_token_versions: Dict[str, int] = {}
+# Users whose existence was confirmed in Mongo; token claims are only trusted for these.
+# Each revocation refresh drops ids that no longer exist, so deleted users lose access.
+known_users: "OrderedDict[str, None]" = OrderedDict()
+revocation_task = None
 
 # Email configuration (optional - for email verification)
 SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
@@ -36,15 +55,74 @@ SMTP_PORT = int(os.environ.get('SMTP_PORT', '587'))
 SMTP_USERNAME = os.environ.get('SMTP_USERNAME', '')
 SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
 
+# Idempotency keys (replayed POSTs return the stored response instead of writing again)
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '10000'))
+# A reservation without a response older than this is treated as abandoned (e.g. the process crashed)
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', '60'))
+idempotency_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+# Single-flight reads (concurrent identical queries share one in-flight Mongo call)
+inflight_reads: Dict[tuple, asyncio.Future] = {}
+
+# Message write mode:
+#   "sync"    - one Mongo write per message, acknowledged after it is stored (default)
+#   "batched" - appends are coalesced into bulk_write batches, acknowledged after their batch is stored
+#   "async"   - appends are coalesced and acknowledged once buffered; a failed batch is only logged
+MESSAGE_WRITE_MODE = os.environ.get('MESSAGE_WRITE_MODE', 'sync')
+MESSAGE_FLUSH_INTERVAL_MS = int(os.environ.get('MESSAGE_FLUSH_INTERVAL_MS', '5'))
+MESSAGE_BATCH_SIZE = int(os.environ.get('MESSAGE_BATCH_SIZE', '500'))
+MESSAGE_BUFFER_MAX = int(os.environ.get('MESSAGE_BUFFER_MAX', '10000'))
+message_buffer = None
+
+# On-demand request profiling (off unless an admin token or a sample rate is configured)
+PROFILE_ADMIN_TOKEN = os.environ.get('PROFILE_ADMIN_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '1'))
+PROFILE_DIR = Path(os.environ.get('PROFILE_DIR', ROOT_DIR / 'profiles'))
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '100'))
+
+# Background chat titles/previews (TITLE_LLM_URL is an OpenAI-compatible server; without it a heuristic is used)
+TITLE_WORKERS = int(os.environ.get('TITLE_WORKERS', '2'))
+TITLE_BATCH_SIZE = int(os.environ.get('TITLE_BATCH_SIZE', '8'))
+TITLE_QUEUE_MAX = int(os.environ.get('TITLE_QUEUE_MAX', '1000'))
+TITLE_LLM_URL = os.environ.get('TITLE_LLM_URL', '')
+TITLE_LLM_MODEL = os.environ.get('TITLE_LLM_MODEL', '')
+# Only chats still carrying this title are titled automatically
+DEFAULT_CHAT_TITLE = "Neuer Chat"
+title_generator = None
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    global client, db
+    global client, db, message_buffer, title_generator, revocation_task
     mongo_url = os.environ['MONGO_URL']
     client = AsyncIOMotorClient(mongo_url)
     db = client[os.environ['DB_NAME']]
+    await db.idempotency_keys.create_index([("user_id", 1), ("key", 1)], unique=True)
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+    await load_token_revocations()
+    revocation_task = asyncio.create_task(refresh_token_revocations())
+    if MESSAGE_WRITE_MODE in ("batched", "async"):
+        message_buffer = MessageWriteBuffer(
+            durable=MESSAGE_WRITE_MODE == "batched",
+            flush_interval=MESSAGE_FLUSH_INTERVAL_MS / 1000,
+            batch_size=MESSAGE_BATCH_SIZE,
+            max_pending=MESSAGE_BUFFER_MAX
+        )
+        message_buffer.start()
+    if TITLE_WORKERS > 0:
+        title_generator = TitleGenerator(workers=TITLE_WORKERS, batch_size=TITLE_BATCH_SIZE, max_queued=TITLE_QUEUE_MAX)
+        title_generator.start()
     yield
     # Shutdown
+    revocation_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await revocation_task
+    if title_generator is not None:
+        await title_generator.close()
+    if message_buffer is not None:
+        await message_buffer.close()
     client.close()
 
 # Create the main app with lifespan events
@@ -54,6 +132,290 @@ app = FastAPI(lifespan=lifespan)
 api_router = APIRouter(prefix="/api")
 
 
+class ProfilingMiddleware:
+    """Profile single requests with pyinstrument and store them as speedscope (flamegraph) files
+
+    A request is profiled when it carries ``X-Profile-Token: <PROFILE_ADMIN_TOKEN>`` or is picked
+    by ``PROFILE_SAMPLE_RATE``. The profile id is returned in the ``X-Profile-Id`` response header.
+    Only the newest ``PROFILE_MAX_FILES`` profiles are kept.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.busy = False
+
+    def should_profile(self, scope) -> bool:
+        if PROFILE_ADMIN_TOKEN:
+            for name, value in scope.get("headers", []):
+                if name == b"x-profile-token":
+                    return secrets.compare_digest(value, PROFILE_ADMIN_TOKEN.encode())
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.busy or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        from pyinstrument import Profiler
+        from pyinstrument.renderers import SpeedscopeRenderer
+
+        profile_id = str(uuid.uuid4())
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        # async_mode attributes time spent awaiting (e.g. Mongo) to the awaiting coroutine
+        profiler = Profiler(interval=PROFILE_INTERVAL_MS / 1000, async_mode="enabled")
+        self.busy = True
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            session = profiler.stop()
+            self.busy = False
+            logger.info(
+                f"Profiled {scope['method']} {scope['path']} as {profile_id}: "
+                f"wall {session.duration * 1000:.1f}ms, cpu {session.cpu_time * 1000:.1f}ms"
+            )
+            # Rendering a large profile takes a while; keep it off the event loop along with the write
+            await asyncio.to_thread(lambda: self.save(profile_id, profiler.output(SpeedscopeRenderer())))
+
+    @staticmethod
+    def save(profile_id: str, profile: str):
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        (PROFILE_DIR / f"{profile_id}.speedscope.json").write_text(profile)
+        profiles = sorted(PROFILE_DIR.glob("*.speedscope.json"), key=lambda path: path.stat().st_mtime)
+        for path in profiles[:-PROFILE_MAX_FILES]:
+            path.unlink(missing_ok=True)
+
+class MessageWriteBuffer:
+    """Write-behind buffer that coalesces message appends per chat into bulk_write batches"""
+
+    def __init__(self, durable: bool, flush_interval: float, batch_size: int, max_pending: int):
+        self.durable = durable
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # Appends wait here once max_pending messages are queued (backpressure)
+        self.slots = asyncio.Semaphore(max_pending)
+        self.pending: Dict[tuple, List[dict]] = {}
+        self.inflight: Dict[tuple, List[dict]] = {}
+        self.pending_count = 0
+        # Durable mode: futures per (user_id, chat_id), resolved when that chat's update is stored
+        self.waiters: Dict[tuple, List[asyncio.Future]] = {}
+        self.has_pending = asyncio.Event()
+        self.batch_full = asyncio.Event()
+        self.closing = False
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        """Flush everything still buffered and stop the flusher"""
+        self.closing = True
+        self.has_pending.set()
+        self.batch_full.set()
+        if self.task is not None:
+            await self.task
+
+    async def append(self, user_id: str, chat_id: str, message: Dict[str, Any]):
+        await self.slots.acquire()
+        key = (user_id, chat_id)
+        self.pending.setdefault(key, []).append(message)
+        self.pending_count += 1
+        waiter = None
+        if self.durable:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.setdefault(key, []).append(waiter)
+        self.has_pending.set()
+        if self.pending_count >= self.batch_size:
+            self.batch_full.set()
+        if waiter is not None:
+            await waiter
+
+    def pending_messages(self, user_id: str, chat_id: str) -> List[dict]:
+        """Messages accepted by this process but not yet confirmed stored, oldest first"""
+        key = (user_id, chat_id)
+        return self.inflight.get(key, []) + self.pending.get(key, [])
+
+    async def run(self):
+        while True:
+            await self.has_pending.wait()
+            if not self.closing and self.pending_count < self.batch_size:
+                try:
+                    await asyncio.wait_for(self.batch_full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush()
+            if self.closing and not self.pending:
+                return
+
+    async def flush(self):
+        batch, waiters, count = self.pending, self.waiters, self.pending_count
+        self.pending, self.waiters, self.pending_count = {}, {}, 0
+        self.has_pending.clear()
+        self.batch_full.clear()
+        if not batch:
+            return
+
+        now = datetime.utcnow()
+        keys = list(batch)
+        operations = [
+            UpdateOne(
+                {"id": chat_id, "user_id": user_id},
+                {
+                    "$push": {"messages": {"$each": batch[(user_id, chat_id)]}},
+                    "$set": {"updated_at": now}
+                }
+            )
+            for user_id, chat_id in keys
+        ]
+
+        self.inflight = batch
+        failed = set()
+        try:
+            await db.chats.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # The write is unordered, so only the chats whose update errored are missing
+            failed = {keys[error["index"]] for error in e.details.get("writeErrors", [])}
+            logger.error(f"Failed to flush buffered messages for {len(failed)} of {len(keys)} chats: {str(e)}")
+        except Exception as e:
+            failed = set(keys)
+            logger.error(f"Failed to flush {count} buffered messages: {str(e)}")
+        finally:
+            self.inflight = {}
+            for _ in range(count):
+                self.slots.release()
+
+        for key, chat_waiters in waiters.items():
+            for waiter in chat_waiters:
+                if waiter.done():
+                    continue
+                if key in failed:
+                    waiter.set_exception(HTTPException(status_code=503, detail="Message could not be stored"))
+                else:
+                    waiter.set_result(None)
+
+class TitleGenerator:
+    """Background queue that titles chats after their first exchange, off the request path"""
+
+    def __init__(self, workers: int, batch_size: int, max_queued: int):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.queued = set()
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def enqueue(self, job: dict):
+        key = (job["user_id"], job["chat_id"])
+        if key in self.queued:
+            return
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            logger.warning(f"Title queue full, skipping chat {job['chat_id']}")
+            return
+        self.queued.add(key)
+
+    async def run(self):
+        while True:
+            # Whatever queued up while the last batch was running goes into the next upstream call
+            jobs = [await self.queue.get()]
+            while len(jobs) < self.batch_size and not self.queue.empty():
+                jobs.append(self.queue.get_nowait())
+            try:
+                await self.process(jobs)
+            except Exception as e:
+                logger.error(f"Failed to generate titles for {len(jobs)} chats: {str(e)}")
+            finally:
+                for job in jobs:
+                    self.queued.discard((job["user_id"], job["chat_id"]))
+
+    async def process(self, jobs: List[dict]):
+        generated = None
+        if TITLE_LLM_URL:
+            try:
+                generated = await asyncio.to_thread(self.request_titles, jobs)
+            except Exception as e:
+                logger.warning(f"Title LLM request failed, falling back to heuristic titles: {str(e)}")
+        if generated is None:
+            generated = [self.heuristic_title(job) for job in jobs]
+        await self.write_titles(jobs, generated)
+
+    @staticmethod
+    async def write_titles(jobs: List[dict], generated: List[tuple]):
+        operations = [
+            UpdateOne(
+                {"id": job["chat_id"], "user_id": job["user_id"]},
+                [{
+                    "$set": {
+                        # Keep titles the user changed since the job was queued
+                        "title": {"$cond": [{"$eq": ["$title", {"$literal": job["title"]}]}, {"$literal": title}, "$title"]},
+                        "preview": {"$literal": preview},
+                        "title_locked": True
+                    }
+                }]
+            )
+            for job, (title, preview) in zip(jobs, generated)
+        ]
+        await db.chats.bulk_write(operations, ordered=False)
+
+    @staticmethod
+    def truncate(text: str, length: int) -> str:
+        text = " ".join(text.split())
+        return text if len(text) <= length else text[:length] + "..."
+
+    @staticmethod
+    def heuristic_title(job: dict) -> tuple:
+        # Same rule the frontend used: first sentence of the question
+        title = TitleGenerator.truncate(job["question"].split(".")[0], 50)
+        if not title.strip():
+            title = "Ohne Titel"
+        return title, TitleGenerator.truncate(job["answer"], 120)
+
+    def request_titles(self, jobs: List[dict]) -> List[tuple]:
+        conversations = "\n\n".join(
+            f"[{i}]\nUser: {self.truncate(job['question'], 500)}\nAssistant: {self.truncate(job['answer'], 500)}"
+            for i, job in enumerate(jobs)
+        )
+        response = requests.post(
+            f"{TITLE_LLM_URL}/v1/chat/completions",
+            json={
+                "model": TITLE_LLM_MODEL,
+                "temperature": 0.2,
+                "stream": False,
+                "messages": [
+                    {
+                        "role": "system",
+                        "content": "Für jede nummerierte Unterhaltung: erzeuge einen kurzen Titel (max. 6 Wörter) "
+                                   "und eine Vorschau (max. 20 Wörter) in der Sprache der Unterhaltung. Antworte nur "
+                                   "mit einem JSON-Array in derselben Reihenfolge: [{\"title\": ..., \"preview\": ...}]"
+                    },
+                    {"role": "user", "content": conversations}
+                ]
+            },
+            timeout=30
+        )
+        response.raise_for_status()
+        content = response.json()["choices"][0]["message"]["content"]
+        items = json.loads(content[content.index("["):content.rindex("]") + 1])
+        if len(items) != len(jobs):
+            raise ValueError(f"expected {len(jobs)} titles, got {len(items)}")
+        return [
+            (self.truncate(str(item["title"]), 60) or "Ohne Titel", self.truncate(str(item.get("preview", "")), 160))
+            for item in items
+        ]
+
 # Define Models
 class StatusCheck(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -74,14 +436,25 @@ class Chat(BaseModel):
     user_id: str
     title: str
     messages: List[ChatMessage] = Field(default_factory=list)
+    archived: bool = False
+    preview: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 class ChatCreate(BaseModel):
-    title: str = "Neuer Chat"
+    title: str = DEFAULT_CHAT_TITLE
 
 class ChatUpdate(BaseModel):
     title: Optional[str] = None
+    archived: Optional[bool] = None
+
+class ChatBulkItem(BaseModel):
+    id: str
+    title: Optional[str] = None  # required for "rename"
+
+class ChatBulkRequest(BaseModel):
+    action: Literal["delete", "rename", "archive"]
+    items: List[ChatBulkItem] = Field(max_length=1000)
 
 class MessageAdd(BaseModel):
     role: str
@@ -96,6 +469,7 @@ class User(BaseModel):
     google_id: str
     verified: bool = False
     verification_token: Optional[str] = None
+    token_version: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class UserCreate(BaseModel):
@@ -108,37 +482,258 @@ class UserLogin(BaseModel):
     google_token: str
 
 # Helper Functions
-def create_access_token(user_id: str, expires_delta: Optional[timedelta] = None):
+def create_access_token(user: User, expires_delta: Optional[timedelta] = None):
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(days=30)  # 30 days for persistent login
     
-    to_encode = {"user_id": user_id, "exp": expire}
+    # User claims let get_current_user skip the database on most routes
+    to_encode = {
+        "user_id": user.id,
+        "email": user.email,
+        "name": user.name,
+        "picture": user.picture,
+        "google_id": user.google_id,
+        "verified": user.verified,
+        "token_version": user.token_version,
+        "exp": expire
+    }
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm="HS256")
     return encoded_jwt
 
 def verify_token(token: str):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        user_id: str = payload.get("user_id")
-        if user_id is None:
+    """Return the token payload, or None if it is invalid, expired or revoked"""
+    payload = verified_tokens.get(token)
+    if payload is not None:
+        if payload["exp"] <= time.time():
+            del verified_tokens[token]
+            return None
+        verified_tokens.move_to_end(token)
+    else:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+        except jwt.PyJWTError:
+            return None
+        if payload.get("user_id") is None:
             return None
-        return user_id
-    except jwt.PyJWTError:
+        verified_tokens[token] = payload
+        while len(verified_tokens) > TOKEN_CACHE_SIZE:
+            verified_tokens.popitem(last=False)
+
+    if payload.get("token_version", 0) < revoked_token_versions.get(payload["user_id"], 0):
         return None
+    return payload
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    user_id = verify_token(credentials.credentials)
-    if user_id is None:
+async def load_token_revocations():
+    global revoked_token_versions
+    users = await db.users.find(
+        {"token_version": {"$gt": 0}}, {"_id": 0, "id": 1, "token_version": 1}
+    ).to_list(None)
+    versions = {user["id"]: user["token_version"] for user in users}
+    # Versions only go up; keep local bumps made while the query was running
+    for user_id, version in revoked_token_versions.items():
+        versions[user_id] = max(version, versions.get(user_id, 0))
+    revoked_token_versions = versions
+
+    if known_users:
+        existing = await db.users.find(
+            {"id": {"$in": list(known_users)}}, {"_id": 0, "id": 1}
+        ).to_list(None)
+        existing_ids = {user["id"] for user in existing}
+        for user_id in [user_id for user_id in known_users if user_id not in existing_ids]:
+            known_users.pop(user_id, None)
+
+def remember_known_user(user_id: str):
+    known_users[user_id] = None
+    known_users.move_to_end(user_id)
+    while len(known_users) > TOKEN_CACHE_SIZE:
+        known_users.popitem(last=False)
+
+async def refresh_token_revocations():
+    while True:
+        await asyncio.sleep(TOKEN_REVOCATION_REFRESH_SECONDS)
+        try:
+            await load_token_revocations()
+        except Exception as e:
+            logger.warning(f"Failed to refresh token revocations: {str(e)}")
+
+async def single_flight(key: tuple, operation):
+    """Share one in-flight call of ``operation`` between all concurrent callers with the same key"""
+    task = inflight_reads.get(key)
+    if task is None:
+        task = asyncio.ensure_future(operation())
+        inflight_reads[key] = task
+
+        def release(done):
+            if inflight_reads.get(key) is done:
+                del inflight_reads[key]
+
+        task.add_done_callback(release)
+    # Shield so one disconnecting client does not cancel the read for everyone else
+    return await asyncio.shield(task)
+
+def end_inflight_reads(kind: str, user_id: str):
+    """Call after a user's write so later reads start fresh instead of joining a pre-write query"""
+    for key in [key for key in inflight_reads if key[:2] == (kind, user_id)]:
+        del inflight_reads[key]
+
+def _message_key(message: Dict[str, Any]) -> tuple:
+    # Mongo stores datetimes with millisecond precision
+    timestamp = message["timestamp"]
+    return message["role"], message["content"], timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+
+def merge_buffered_messages(chat: Dict[str, Any]) -> Dict[str, Any]:
+    """Append messages still sitting in the write-behind buffer so reads see this process's writes"""
+    if message_buffer is None:
+        return chat
+    buffered = message_buffer.pending_messages(chat["user_id"], chat["id"])
+    if not buffered:
+        return chat
+    messages = chat.get("messages", [])
+    stored = {_message_key(m) for m in messages}
+    chat["messages"] = messages + [m for m in buffered if _message_key(m) not in stored]
+    return chat
+
+def title_job(chat: Dict[str, Any], reply: str) -> Optional[dict]:
+    """Build a title job from the chat's first user message and the assistant reply that followed it"""
+    messages = merge_buffered_messages(chat).get("messages", []) + [{"role": "assistant", "content": reply}]
+    question_index = next((i for i, m in enumerate(messages) if m["role"] == "user"), None)
+    if question_index is None:
+        return None
+    answer = next(m["content"] for m in messages[question_index + 1:] if m["role"] == "assistant")
+    return {
+        "user_id": chat["user_id"],
+        "chat_id": chat["id"],
+        "title": chat["title"],
+        "question": messages[question_index]["content"],
+        "answer": answer
+    }
+
+async def get_current_user_from_db(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Authenticate against the stored user, for routes that need fresh user data"""
+    payload = verify_token(credentials.credentials)
+    if payload is None:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     
-    user = await db.users.find_one({"id": user_id})
+    user_id = payload["user_id"]
+    user = await single_flight(("user", user_id), lambda: db.users.find_one({"id": user_id}))
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
+    if payload.get("token_version", 0) < user.get("token_version", 0):
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     
+    remember_known_user(user_id)
     return User(**user)
 
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = verify_token(credentials.credentials)
+    if payload is None:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    
+    # Tokens issued before user claims were added, and users not confirmed to exist, need the database lookup
+    if "google_id" not in payload or payload["user_id"] not in known_users:
+        return await get_current_user_from_db(credentials)
+    
+    return User(
+        id=payload["user_id"],
+        email=payload["email"],
+        name=payload["name"],
+        picture=payload.get("picture"),
+        google_id=payload["google_id"],
+        verified=payload["verified"],
+        token_version=payload.get("token_version", 0)
+    )
+
+def _idempotency_cache_get(cache_key: tuple):
+    entry = idempotency_cache.get(cache_key)
+    if entry is None:
+        return None
+    expires_at, route, request_hash, response = entry
+    if expires_at < time.monotonic():
+        del idempotency_cache[cache_key]
+        return None
+    idempotency_cache.move_to_end(cache_key)
+    return route, request_hash, response
+
+def _idempotency_cache_put(cache_key: tuple, route: str, request_hash: str, response: Dict[str, Any]):
+    idempotency_cache[cache_key] = (time.monotonic() + IDEMPOTENCY_TTL_SECONDS, route, request_hash, response)
+    idempotency_cache.move_to_end(cache_key)
+    while len(idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+        idempotency_cache.popitem(last=False)
+
+def _hash_request(body: Any) -> str:
+    return hashlib.sha256(json.dumps(jsonable_encoder(body), sort_keys=True).encode()).hexdigest()
+
+def _check_idempotent_request(stored_route: str, stored_hash: str, route: str, request_hash: str):
+    if stored_route != route or stored_hash != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+
+async def run_idempotent(user_id: str, key: Optional[str], route: str, body: Any, operation):
+    """Run a write at most once per (user, Idempotency-Key) and replay its response on retries
+
+    ``operation`` must be safe to run again for the same key: when a reservation is taken over after its
+    lease expired, the earlier attempt may already have written, and the operation has to detect that.
+    """
+    if not key:
+        return await operation()
+
+    request_hash = _hash_request(body)
+    cache_key = (user_id, key)
+    cached = _idempotency_cache_get(cache_key)
+    if cached is not None:
+        stored_route, stored_hash, response = cached
+        _check_idempotent_request(stored_route, stored_hash, route, request_hash)
+        return response
+
+    # Reserve the key first; the unique index makes concurrent retries lose the race here
+    now = datetime.utcnow()
+    lease_expires_at = now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+    try:
+        await db.idempotency_keys.insert_one({
+            "user_id": user_id,
+            "key": key,
+            "route": route,
+            "request_hash": request_hash,
+            "response": None,
+            "lease_expires_at": lease_expires_at,
+            "created_at": now
+        })
+    except DuplicateKeyError:
+        existing = await db.idempotency_keys.find_one({"user_id": user_id, "key": key})
+        if existing is None:
+            raise HTTPException(status_code=409, detail="Request with this Idempotency-Key is being retried, try again")
+        _check_idempotent_request(existing["route"], existing.get("request_hash"), route, request_hash)
+        if existing.get("response") is not None:
+            _idempotency_cache_put(cache_key, route, request_hash, existing["response"])
+            return existing["response"]
+        # Take over a reservation whose owner never finished; the lease value guards against a second taker
+        taken_over = False
+        if existing["lease_expires_at"] < now:
+            result = await db.idempotency_keys.update_one(
+                {"user_id": user_id, "key": key, "response": None, "lease_expires_at": existing["lease_expires_at"]},
+                {"$set": {"lease_expires_at": lease_expires_at}}
+            )
+            taken_over = result.modified_count == 1
+        if not taken_over:
+            raise HTTPException(status_code=409, detail="Request with this Idempotency-Key is still in progress")
+
+    try:
+        response = await operation()
+    except HTTPException:
+        # Operations only raise HTTPException when nothing was written (e.g. chat not found), so retries may run
+        await db.idempotency_keys.delete_one({"user_id": user_id, "key": key, "response": None})
+        raise
+    # On cancellation or any other error the write may still land (a running Motor call or a buffered
+    # message is not undone), so the key stays reserved until its lease expires and a retry takes it over
+
+    await db.idempotency_keys.update_one(
+        {"user_id": user_id, "key": key},
+        {"$set": {"response": response}}
+    )
+    _idempotency_cache_put(cache_key, route, request_hash, response)
+    return response
+
 def generate_verification_token():
     return secrets.token_urlsafe(32)
 
@@ -218,7 +813,7 @@ async def login_user(user_data: UserCreate):
             user = user_obj
         
         # Create access token
-        access_token = create_access_token(user.id)
+        access_token = create_access_token(user)
         
         return {
             "access_token": access_token,
@@ -249,8 +844,22 @@ async def verify_email(token: str):
     
     return {"message": "Email verified successfully"}
 
+@api_router.post("/auth/logout-all")
+async def logout_all_sessions(current_user: User = Depends(get_current_user_from_db)):
+    """Revoke every access token issued to the current user"""
+    user = await db.users.find_one_and_update(
+        {"id": current_user.id},
+        {"$inc": {"token_version": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if user is None:
+        # Deleted since authentication
+        raise HTTPException(status_code=401, detail="User not found")
+    revoked_token_versions[current_user.id] = user["token_version"]
+    return {"message": "All sessions logged out"}
+
 @api_router.get("/auth/me")
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(current_user: User = Depends(get_current_user_from_db)):
     """Get current user information"""
     return {
         "id": current_user.id,
@@ -262,19 +871,114 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
 
 # Chat Routes
 @api_router.get("/chats", response_model=List[Chat])
-async def get_user_chats(current_user: User = Depends(get_current_user)):
+async def get_user_chats(archived: bool = False, current_user: User = Depends(get_current_user)):
     """Get all chats for the current user"""
-    chats = await db.chats.find({"user_id": current_user.id}).sort("updated_at", -1).to_list(100)
-    return [Chat(**chat) for chat in chats]
+    query = {"user_id": current_user.id, "archived": True if archived else {"$ne": True}}
+
+    async def load_chats():
+        chats = await db.chats.find(query).sort("updated_at", -1).to_list(100)
+        return json.dumps(jsonable_encoder([Chat(**merge_buffered_messages(chat)) for chat in chats])).encode()
+
+    # Concurrent tabs share one query and one serialized body
+    body = await single_flight(("chats", current_user.id, archived), load_chats)
+    return Response(content=body, media_type="application/json")
 
 @api_router.post("/chats", response_model=Chat)
-async def create_chat(chat_data: ChatCreate, current_user: User = Depends(get_current_user)):
+async def create_chat(
+    chat_data: ChatCreate,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
     """Create a new chat"""
-    chat_dict = chat_data.dict()
-    chat_dict["user_id"] = current_user.id
-    chat_obj = Chat(**chat_dict)
-    await db.chats.insert_one(chat_obj.dict())
-    return chat_obj
+    async def insert_chat():
+        chat_dict = chat_data.dict()
+        chat_dict["user_id"] = current_user.id
+        if idempotency_key:
+            # The same key always maps to the same chat id, so a re-run finds the chat instead of adding one
+            chat_dict["id"] = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{current_user.id}:{idempotency_key}"))
+        chat_obj = Chat(**chat_dict)
+        if idempotency_key:
+            result = await db.chats.update_one(
+                {"id": chat_obj.id, "user_id": current_user.id},
+                {"$setOnInsert": chat_obj.dict()},
+                upsert=True
+            )
+            if result.upserted_id is None:
+                chat_obj = Chat(**await db.chats.find_one({"id": chat_obj.id, "user_id": current_user.id}))
+        else:
+            await db.chats.insert_one(chat_obj.dict())
+        end_inflight_reads("chats", current_user.id)
+        return chat_obj.dict()
+
+    chat = await run_idempotent(current_user.id, idempotency_key, "POST /chats", chat_data, insert_chat)
+    return Chat(**chat)
+
+@api_router.post("/chats/bulk")
+async def bulk_update_chats(bulk: ChatBulkRequest, current_user: User = Depends(get_current_user)):
+    """Delete, rename or archive many chats in one bulk write"""
+    ids = [item.id for item in bulk.items]
+    owned = await db.chats.find(
+        {"id": {"$in": ids}, "user_id": current_user.id}, {"_id": 0, "id": 1}
+    ).to_list(len(ids))
+    owned_ids = {chat["id"] for chat in owned}
+
+    now = datetime.utcnow()
+    operations = []
+    results = []
+    queued = []  # the result behind each operation, in operation order
+    for item in bulk.items:
+        if item.id not in owned_ids:
+            results.append({"id": item.id, "status": "not_found"})
+            continue
+        query = {"id": item.id, "user_id": current_user.id}
+        if bulk.action == "delete":
+            operations.append(DeleteOne(query))
+        elif bulk.action == "rename":
+            if not item.title:
+                results.append({"id": item.id, "status": "invalid", "detail": "title is required"})
+                continue
+            operations.append(UpdateOne(query, {"$set": {"title": item.title, "title_locked": True, "updated_at": now}}))
+        else:
+            operations.append(UpdateOne(query, {"$set": {"archived": True, "updated_at": now}}))
+        result = {"id": item.id, "status": "ok"}
+        results.append(result)
+        queued.append(result)
+
+    if operations:
+        try:
+            counts = (await db.chats.bulk_write(operations, ordered=False)).bulk_api_result
+        except BulkWriteError as e:
+            # The write is unordered, so every operation without a write error was still applied
+            counts = e.details
+            for error in e.details.get("writeErrors", []):
+                queued[error["index"]].update(status="error", detail="write failed")
+            logger.error(f"Bulk {bulk.action} failed for {len(e.details.get('writeErrors', []))} chats: {str(e)}")
+        end_inflight_reads("chats", current_user.id)
+
+        # A chat deleted after the ownership check is not matched by its update, so report it as not found.
+        # Deletes are left as "ok": the chat is gone either way, whichever request removed it.
+        applied = [result for result in queued if result["status"] == "ok"]
+        if bulk.action != "delete" and counts.get("nMatched", 0) < len(applied):
+            remaining = await db.chats.find(
+                {"id": {"$in": [result["id"] for result in applied]}, "user_id": current_user.id},
+                {"_id": 0, "id": 1}
+            ).to_list(None)
+            remaining_ids = {chat["id"] for chat in remaining}
+            for result in applied:
+                if result["id"] not in remaining_ids:
+                    result["status"] = "not_found"
+
+    return {"action": bulk.action, "results": results}
+
+@api_router.delete("/chats")
+async def delete_old_chats(older_than_days: int, current_user: User = Depends(get_current_user)):
+    """Delete all chats not updated within the last N days"""
+    if older_than_days < 0:
+        raise HTTPException(status_code=400, detail="older_than_days must not be negative")
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    result = await db.chats.delete_many({"user_id": current_user.id, "updated_at": {"$lt": cutoff}})
+    end_inflight_reads("chats", current_user.id)
+    return {"deleted_count": result.deleted_count}
 
 @api_router.get("/chats/{chat_id}", response_model=Chat)
 async def get_chat(chat_id: str, current_user: User = Depends(get_current_user)):
@@ -282,54 +986,97 @@ async def get_chat(chat_id: str, current_user: User = Depends(get_current_user))
     chat = await db.chats.find_one({"id": chat_id, "user_id": current_user.id})
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    return Chat(**chat)
+    return Chat(**merge_buffered_messages(chat))
 
 @api_router.put("/chats/{chat_id}", response_model=Chat)
 async def update_chat(chat_id: str, chat_update: ChatUpdate, current_user: User = Depends(get_current_user)):
     """Update chat title"""
     update_data = {k: v for k, v in chat_update.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
+    if chat_update.title is not None:
+        # A title chosen by the user is never replaced by a generated one
+        update_data["title_locked"] = True
     
     result = await db.chats.update_one(
         {"id": chat_id, "user_id": current_user.id},
         {"$set": update_data}
     )
+    end_inflight_reads("chats", current_user.id)
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Chat not found")
     
     updated_chat = await db.chats.find_one({"id": chat_id, "user_id": current_user.id})
-    return Chat(**updated_chat)
+    return Chat(**merge_buffered_messages(updated_chat))
 
 @api_router.delete("/chats/{chat_id}")
 async def delete_chat(chat_id: str, current_user: User = Depends(get_current_user)):
     """Delete a chat"""
     result = await db.chats.delete_one({"id": chat_id, "user_id": current_user.id})
+    end_inflight_reads("chats", current_user.id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Chat not found")
     return {"message": "Chat deleted successfully"}
 
 @api_router.post("/chats/{chat_id}/messages")
-async def add_message_to_chat(chat_id: str, message: MessageAdd, current_user: User = Depends(get_current_user)):
+async def add_message_to_chat(
+    chat_id: str,
+    message: MessageAdd,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
     """Add a message to a chat"""
-    # Check if chat exists and belongs to user
-    chat = await db.chats.find_one({"id": chat_id, "user_id": current_user.id})
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    
-    # Create message
-    chat_message = ChatMessage(role=message.role, content=message.content)
-    
-    # Update chat with new message
-    await db.chats.update_one(
-        {"id": chat_id, "user_id": current_user.id},
-        {
-            "$push": {"messages": chat_message.dict()},
-            "$set": {"updated_at": datetime.utcnow()}
-        }
+    async def push_message():
+        # Check if chat exists and belongs to user
+        chat = await db.chats.find_one({"id": chat_id, "user_id": current_user.id})
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        
+        if idempotency_key:
+            # An earlier attempt with this key may already have stored or buffered the message
+            messages = merge_buffered_messages(dict(chat)).get("messages", [])
+            if any(m.get("idempotency_key") == idempotency_key for m in messages):
+                return {"message": "Message added successfully"}
+        
+        # Create message
+        chat_message = ChatMessage(role=message.role, content=message.content)
+        message_doc = chat_message.dict()
+        query = {"id": chat_id, "user_id": current_user.id}
+        if idempotency_key:
+            message_doc["idempotency_key"] = idempotency_key
+            query["messages.idempotency_key"] = {"$ne": idempotency_key}
+        
+        # Update chat with new message
+        if message_buffer is not None:
+            await message_buffer.append(current_user.id, chat_id, message_doc)
+        else:
+            await db.chats.update_one(
+                query,
+                {
+                    "$push": {"messages": message_doc},
+                    "$set": {"updated_at": datetime.utcnow()}
+                }
+            )
+        end_inflight_reads("chats", current_user.id)
+
+        # Title the chat once its first exchange is stored, unless the user already named it
+        if message.role == "assistant" and chat["title"] == DEFAULT_CHAT_TITLE and not chat.get("title_locked"):
+            job = title_job(chat, message.content)
+            if job is not None and title_generator is not None:
+                title_generator.enqueue(job)
+            elif job is not None:
+                # No title workers: store the heuristic title inline so the chat does not keep the default.
+                # The message is already stored, so a failed title write must not fail the request.
+                try:
+                    await TitleGenerator.write_titles([job], [TitleGenerator.heuristic_title(job)])
+                except Exception as e:
+                    logger.error(f"Failed to store title for chat {chat_id}: {str(e)}")
+        
+        return {"message": "Message added successfully"}
+
+    return await run_idempotent(
+        current_user.id, idempotency_key, f"POST /chats/{chat_id}/messages", message, push_message
     )
-    
-    return {"message": "Message added successfully"}
 
 @api_router.get("/chats/{chat_id}/messages")
 async def get_chat_messages(chat_id: str, current_user: User = Depends(get_current_user)):
@@ -338,11 +1085,14 @@ async def get_chat_messages(chat_id: str, current_user: User = Depends(get_curre
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    return {"messages": chat.get("messages", [])}
+    return {"messages": merge_buffered_messages(chat).get("messages", [])}
 
 # Include the router in the main app
 app.include_router(api_router)
 
+if PROFILE_ADMIN_TOKEN or PROFILE_SAMPLE_RATE > 0:
+    app.add_middleware(ProfilingMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
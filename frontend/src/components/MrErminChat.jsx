@@ -510,7 +510,8 @@ export default function MrErminChat() {
     }
   };
 
-  const updateChatTitle = async (chatId, content) => {
+  const updateChatTitle = (chatId, content) => {
+    // Nur lokale Vorschau; angemeldete Chats erhalten ihren Titel vom Server
     let title = content.split('.')[0].substring(0, 50);
     if (title.length === 50) title += '...';
     if (title.trim() === '') title = 'Ohne Titel';
@@ -522,18 +523,6 @@ export default function MrErminChat() {
         title: title
       }
     }));
-
-    if (!isGuestMode) {
-      try {
-        await axios.put(`${API}/chats/${chatId}`, {
-          title: title
-        }, {
-          headers: { 'Authorization': `Bearer ${authToken}` }
-        });
-      } catch (error) {
-        console.error('Error updating chat title:', error);
-      }
-    }
   };
 
   // Auto-scroll zu neuen Nachrichten
@@ -0,0 +1,236 @@
+import asyncio
+import copy
+import os
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+
+import server  # noqa: E402
+
+
+def _get(doc, field):
+    value = doc
+    for part in field.split("."):
+        if isinstance(value, list):
+            value = [item.get(part) for item in value]
+        else:
+            value = value.get(part) if value is not None else None
+    return value
+
+
+def _matches(doc, query):
+    for field, condition in query.items():
+        value = _get(doc, field)
+        if isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+            for op, arg in condition.items():
+                if op == "$in" and value not in arg:
+                    return False
+                if op == "$ne" and (arg in value if isinstance(value, list) else value == arg):
+                    return False
+                if op == "$lt" and not (value is not None and value < arg):
+                    return False
+                if op == "$gt" and not (value is not None and value > arg):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _evaluate(doc, expression):
+    if isinstance(expression, str) and expression.startswith("$"):
+        return doc.get(expression[1:])
+    if isinstance(expression, dict):
+        if "$literal" in expression:
+            return expression["$literal"]
+        if "$eq" in expression:
+            left, right = expression["$eq"]
+            return _evaluate(doc, left) == _evaluate(doc, right)
+        if "$cond" in expression:
+            condition, then, otherwise = expression["$cond"]
+            return _evaluate(doc, then) if _evaluate(doc, condition) else _evaluate(doc, otherwise)
+    return expression
+
+
+def _apply_update(doc, update):
+    if isinstance(update, list):
+        for stage in update:
+            values = {field: _evaluate(doc, expr) for field, expr in stage["$set"].items()}
+            doc.update(values)
+        return
+    for field, value in update.get("$set", {}).items():
+        doc[field] = copy.deepcopy(value)
+    for field, value in update.get("$inc", {}).items():
+        doc[field] = doc.get(field, 0) + value
+    for field, value in update.get("$push", {}).items():
+        items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+        doc.setdefault(field, []).extend(copy.deepcopy(items))
+
+
+class Result:
+    def __init__(self, **counts):
+        self.__dict__.update(counts)
+
+
+class FakeCursor:
+    def __init__(self, collection, docs):
+        self.collection = collection
+        self.docs = docs
+
+    def sort(self, field, direction):
+        self.docs.sort(key=lambda doc: doc.get(field), reverse=direction < 0)
+        return self
+
+    async def to_list(self, length):
+        await asyncio.sleep(0)
+        if self.collection.read_gate is not None:
+            await self.collection.read_gate.wait()
+        return self.docs if length is None else self.docs[:length]
+
+
+class FakeCollection:
+    """Just enough of an AsyncIOMotorCollection for the server's queries"""
+
+    def __init__(self):
+        self.docs = []
+        self.unique = []
+        self.calls = []
+        self.fail_bulk_indexes = set()
+        # When set, find().to_list() waits on this event (holds reads in flight)
+        self.read_gate = None
+
+    async def create_index(self, keys, unique=False, **kwargs):
+        if unique:
+            self.unique.append([key for key, _ in keys])
+
+    async def insert_one(self, doc):
+        await asyncio.sleep(0)
+        self.calls.append("insert_one")
+        for fields in self.unique:
+            if any(all(d.get(f) == doc.get(f) for f in fields) for d in self.docs):
+                raise DuplicateKeyError("duplicate key")
+        self.docs.append(copy.deepcopy(doc))
+        return Result(inserted_id=doc.get("id"))
+
+    async def find_one(self, query, projection=None):
+        await asyncio.sleep(0)
+        self.calls.append("find_one")
+        for doc in self.docs:
+            if _matches(doc, query):
+                return copy.deepcopy(doc)
+        return None
+
+    def find(self, query=None, projection=None):
+        self.calls.append("find")
+        return FakeCursor(self, [copy.deepcopy(d) for d in self.docs if _matches(d, query or {})])
+
+    async def update_one(self, query, update, upsert=False):
+        await asyncio.sleep(0)
+        self.calls.append("update_one")
+        for doc in self.docs:
+            if _matches(doc, query):
+                _apply_update(doc, update)
+                return Result(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            doc = {field: value for field, value in query.items() if not isinstance(value, dict)}
+            doc.update(copy.deepcopy(update.get("$setOnInsert", {})))
+            _apply_update(doc, update)
+            self.docs.append(doc)
+            return Result(matched_count=0, modified_count=0, upserted_id=doc.get("id"))
+        return Result(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def find_one_and_update(self, query, update, return_document=None):
+        await asyncio.sleep(0)
+        for doc in self.docs:
+            if _matches(doc, query):
+                _apply_update(doc, update)
+                return copy.deepcopy(doc)
+        return None
+
+    async def delete_one(self, query):
+        await asyncio.sleep(0)
+        self.calls.append("delete_one")
+        for doc in self.docs:
+            if _matches(doc, query):
+                self.docs.remove(doc)
+                return Result(deleted_count=1)
+        return Result(deleted_count=0)
+
+    async def delete_many(self, query):
+        await asyncio.sleep(0)
+        self.calls.append("delete_many")
+        before = len(self.docs)
+        self.docs = [doc for doc in self.docs if not _matches(doc, query)]
+        return Result(deleted_count=before - len(self.docs))
+
+    async def bulk_write(self, operations, ordered=True):
+        await asyncio.sleep(0)
+        self.calls.append("bulk_write")
+        errors = []
+        counts = {"nInserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0}
+        for index, operation in enumerate(operations):
+            if index in self.fail_bulk_indexes:
+                errors.append({"index": index, "code": 2, "errmsg": "injected failure"})
+                continue
+            matching = [doc for doc in self.docs if _matches(doc, operation._filter)]
+            if isinstance(operation, DeleteOne):
+                if matching:
+                    self.docs.remove(matching[0])
+                    counts["nRemoved"] += 1
+            elif isinstance(operation, UpdateOne):
+                if matching:
+                    _apply_update(matching[0], operation._doc)
+                    counts["nMatched"] += 1
+                    counts["nModified"] += 1
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": [], **counts})
+        return Result(bulk_api_result=counts)
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self.collections.setdefault(name, FakeCollection())
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDatabase()
+    asyncio.run(fake.idempotency_keys.create_index([("user_id", 1), ("key", 1)], unique=True))
+    monkeypatch.setattr(server, "db", fake)
+    monkeypatch.setattr(server, "message_buffer", None)
+    monkeypatch.setattr(server, "title_generator", None)
+    server.idempotency_cache.clear()
+    server.inflight_reads.clear()
+    server.verified_tokens.clear()
+    server.known_users.clear()
+    monkeypatch.setattr(server, "revoked_token_versions", {})
+    return fake
+
+
+@pytest.fixture
+def user():
+    return server.User(id="user-1", email="maria.schmidt@gmail.com", name="Maria Schmidt", google_id="108234567890")
+
+
+@pytest.fixture
+def chat_doc(user):
+    """Build a stored chat document; it belongs to ``user`` unless another ``user_id`` is given"""
+    def make(chat_id, user_id=None, updated_days_ago=0):
+        updated_at = datetime.utcnow() - timedelta(days=updated_days_ago)
+        chat = server.Chat(
+            id=chat_id, user_id=user_id or user.id, title=server.DEFAULT_CHAT_TITLE, updated_at=updated_at
+        )
+        return chat.dict()
+    return make
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+import server
+from tests.conftest import FakeDatabase
+
+
+def credentials_for(user):
+    token = server.create_access_token(user)
+    return HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+
+def authenticate(credentials):
+    return asyncio.run(server.get_current_user(credentials))
+
+
+def test_claims_skip_database_after_first_lookup(db, user):
+    db.users.docs.append(user.dict())
+    credentials = credentials_for(user)
+
+    assert authenticate(credentials).id == user.id
+    lookups = db.users.calls.count("find_one")
+    assert authenticate(credentials).email == user.email
+    assert db.users.calls.count("find_one") == lookups
+
+
+def test_deleted_user_is_rejected_on_claims_route(db, user):
+    db.users.docs.append(user.dict())
+    credentials = credentials_for(user)
+    assert authenticate(credentials).id == user.id
+
+    db.users.docs.clear()
+    asyncio.run(server.load_token_revocations())
+
+    with pytest.raises(HTTPException) as error:
+        authenticate(credentials)
+    assert error.value.status_code == 401
+
+
+def test_logout_all_revokes_existing_tokens(db, user):
+    db.users.docs.append(user.dict())
+    credentials = credentials_for(user)
+    current = authenticate(credentials)
+
+    asyncio.run(server.logout_all_sessions(current_user=current))
+
+    with pytest.raises(HTTPException) as error:
+        authenticate(credentials)
+    assert error.value.status_code == 401
+    fresh = server.User(**db.users.docs[0])
+    assert authenticate(credentials_for(fresh)).id == user.id
+
+
+def test_logout_all_for_deleted_user_is_unauthorized(db, user):
+    db.users.docs.append(user.dict())
+    current = authenticate(credentials_for(user))
+    db.users.docs.clear()
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.logout_all_sessions(current_user=current))
+    assert error.value.status_code == 401
+
+
+def test_lifespan_shutdown_awaits_revocation_refresh(monkeypatch):
+    closed = []
+
+    class FakeClient:
+        def __init__(self, url):
+            self.database = FakeDatabase()
+
+        def __getitem__(self, name):
+            return self.database
+
+        def close(self):
+            closed.append(server.revocation_task.done())
+
+    monkeypatch.setattr(server, "AsyncIOMotorClient", FakeClient)
+    monkeypatch.setattr(server, "TITLE_WORKERS", 0)
+    monkeypatch.setattr(server, "revoked_token_versions", {})
+
+    async def scenario():
+        async with server.lifespan(server.app):
+            pass
+
+    asyncio.run(scenario())
+    assert closed == [True]
@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+import server
+
+
+def bulk(user, action, items):
+    request = server.ChatBulkRequest(action=action, items=items)
+    return asyncio.run(server.bulk_update_chats(request, current_user=user))
+
+
+def test_bulk_delete_reports_each_item(db, user, chat_doc):
+    db.chats.docs += [chat_doc("chat-1"), chat_doc("chat-2"), chat_doc("chat-3", user_id="someone-else")]
+
+    result = bulk(user, "delete", [{"id": "chat-1"}, {"id": "chat-3"}, {"id": "missing"}])
+
+    assert result["results"] == [
+        {"id": "chat-1", "status": "ok"},
+        {"id": "chat-3", "status": "not_found"},
+        {"id": "missing", "status": "not_found"},
+    ]
+    assert sorted(doc["id"] for doc in db.chats.docs) == ["chat-2", "chat-3"]
+    assert db.chats.calls.count("bulk_write") == 1
+
+
+def test_bulk_rename_requires_a_title(db, user, chat_doc):
+    db.chats.docs += [chat_doc("chat-1"), chat_doc("chat-2")]
+
+    result = bulk(user, "rename", [{"id": "chat-1", "title": "Urlaub"}, {"id": "chat-2"}])
+
+    assert [item["status"] for item in result["results"]] == ["ok", "invalid"]
+    assert [doc["title"] for doc in db.chats.docs] == ["Urlaub", "Neuer Chat"]
+
+
+def test_bulk_archive_hides_chats_from_list(db, user, chat_doc):
+    db.chats.docs += [chat_doc("chat-1"), chat_doc("chat-2")]
+
+    bulk(user, "archive", [{"id": "chat-1"}])
+
+    listed = asyncio.run(server.get_user_chats(archived=False, current_user=user))
+    archived = asyncio.run(server.get_user_chats(archived=True, current_user=user))
+    assert [chat["id"] for chat in json.loads(listed.body)] == ["chat-2"]
+    assert [chat["id"] for chat in json.loads(archived.body)] == ["chat-1"]
+
+
+def test_delete_chats_older_than(db, user, chat_doc):
+    db.chats.docs += [
+        chat_doc("old", updated_days_ago=40),
+        chat_doc("recent", updated_days_ago=1),
+        chat_doc("other-old", user_id="someone-else", updated_days_ago=40),
+    ]
+
+    result = asyncio.run(server.delete_old_chats(30, current_user=user))
+
+    assert result == {"deleted_count": 1}
+    assert sorted(doc["id"] for doc in db.chats.docs) == ["other-old", "recent"]
+
+
+def test_bulk_write_error_is_reported_per_item(db, user, chat_doc):
+    db.chats.docs += [chat_doc("chat-1"), chat_doc("chat-2"), chat_doc("chat-3")]
+    db.chats.fail_bulk_indexes = {1}
+
+    result = bulk(user, "archive", [{"id": "chat-1"}, {"id": "chat-2"}, {"id": "chat-3"}])
+
+    assert [item["status"] for item in result["results"]] == ["ok", "error", "ok"]
+    assert [doc["archived"] for doc in db.chats.docs] == [True, False, True]
+
+
+def test_chat_deleted_before_bulk_write_is_not_reported_ok(db, user, chat_doc, monkeypatch):
+    db.chats.docs += [chat_doc("chat-1"), chat_doc("chat-2")]
+    bulk_write = db.chats.bulk_write
+
+    async def delete_then_bulk_write(operations, ordered=True):
+        # Another request deletes chat-2 after the ownership check
+        db.chats.docs = [doc for doc in db.chats.docs if doc["id"] != "chat-2"]
+        return await bulk_write(operations, ordered=ordered)
+
+    monkeypatch.setattr(db.chats, "bulk_write", delete_then_bulk_write)
+    result = bulk(user, "rename", [{"id": "chat-1", "title": "Eins"}, {"id": "chat-2", "title": "Zwei"}])
+
+    assert [item["status"] for item in result["results"]] == ["ok", "not_found"]
@@ -0,0 +1,135 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def create_chat(user, key, title="Neuer Chat"):
+    return server.create_chat(server.ChatCreate(title=title), current_user=user, idempotency_key=key)
+
+
+def test_replay_returns_original_response_without_writing(db, user):
+    async def scenario():
+        first = await create_chat(user, "key-1")
+        server.idempotency_cache.clear()  # force the Mongo path
+        second = await create_chat(user, "key-1")
+        third = await create_chat(user, "key-1")
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert first.id == second.id == third.id
+    assert len(db.chats.docs) == 1
+
+
+def test_concurrent_retries_write_once(db, user):
+    async def scenario():
+        return await asyncio.gather(*(create_chat(user, "key-1") for _ in range(5)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    chats = [r for r in results if isinstance(r, server.Chat)]
+    conflicts = [r for r in results if isinstance(r, HTTPException)]
+    assert len(db.chats.docs) == 1
+    assert len(chats) == 1
+    assert all(c.status_code == 409 for c in conflicts)
+    assert len(chats) + len(conflicts) == 5
+
+
+def test_key_reused_with_different_body_is_rejected(db, user):
+    asyncio.run(create_chat(user, "key-1", title="Erster"))
+    for clear_cache in (False, True):
+        if clear_cache:
+            server.idempotency_cache.clear()
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(create_chat(user, "key-1", title="Zweiter"))
+        assert error.value.status_code == 422
+    assert len(db.chats.docs) == 1
+
+
+def add_message(user, chat_id, key, content="hi"):
+    return server.add_message_to_chat(
+        chat_id, server.MessageAdd(role="user", content=content), current_user=user, idempotency_key=key
+    )
+
+
+def expire_leases(db):
+    for reservation in db.idempotency_keys.docs:
+        reservation["lease_expires_at"] = datetime.utcnow() - timedelta(seconds=1)
+
+
+def test_write_that_never_started_releases_key(db, user):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(add_message(user, "missing", "key-1"))
+    assert error.value.status_code == 404
+    assert db.idempotency_keys.docs == []
+
+
+def test_cancelled_buffered_append_is_not_duplicated_by_retry(db, user, chat_doc, monkeypatch):
+    db.chats.docs.append(chat_doc("chat-1"))
+
+    async def scenario():
+        buffer = server.MessageWriteBuffer(durable=True, flush_interval=60, batch_size=500, max_pending=100)
+        monkeypatch.setattr(server, "message_buffer", buffer)
+        buffer.start()
+        first = asyncio.create_task(add_message(user, "chat-1", "key-1"))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+
+        # The message is still buffered, so the key stays reserved
+        with pytest.raises(HTTPException) as error:
+            await add_message(user, "chat-1", "key-1")
+        assert error.value.status_code == 409
+
+        expire_leases(db)
+        await add_message(user, "chat-1", "key-1")
+        await buffer.close()
+
+    asyncio.run(scenario())
+    assert [m["content"] for m in db.chats.docs[0]["messages"]] == ["hi"]
+
+
+def test_taken_over_message_is_not_pushed_twice(db, user, chat_doc):
+    db.chats.docs.append(chat_doc("chat-1"))
+    asyncio.run(add_message(user, "chat-1", "key-1"))
+
+    # Simulate a lost response: the message landed but the reservation never got it
+    db.idempotency_keys.docs[0]["response"] = None
+    expire_leases(db)
+    server.idempotency_cache.clear()
+    asyncio.run(add_message(user, "chat-1", "key-1"))
+
+    assert [m["content"] for m in db.chats.docs[0]["messages"]] == ["hi"]
+    assert db.idempotency_keys.docs[0]["response"] == {"message": "Message added successfully"}
+
+
+def test_abandoned_reservation_is_taken_over(db, user):
+    def reserve(lease_expires_at):
+        db.idempotency_keys.docs = [{
+            "user_id": user.id,
+            "key": "key-1",
+            "route": "POST /chats",
+            "request_hash": server._hash_request(server.ChatCreate()),
+            "response": None,
+            "lease_expires_at": lease_expires_at,
+            "created_at": datetime.utcnow()
+        }]
+
+    reserve(datetime.utcnow() + timedelta(seconds=60))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(create_chat(user, "key-1"))
+    assert error.value.status_code == 409
+
+    reserve(datetime.utcnow() - timedelta(seconds=1))
+    chat = asyncio.run(create_chat(user, "key-1"))
+    assert [c["id"] for c in db.chats.docs] == [chat.id]
+    assert db.idempotency_keys.docs[0]["response"]["id"] == chat.id
+
+    # The earlier owner's chat already landed: a takeover returns it instead of creating another
+    reserve(datetime.utcnow() - timedelta(seconds=1))
+    server.idempotency_cache.clear()
+    again = asyncio.run(create_chat(user, "key-1"))
+    assert again.id == chat.id
+    assert len(db.chats.docs) == 1
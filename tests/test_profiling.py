@@ -0,0 +1,65 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import server
+
+
+def scope_with_token(token: bytes):
+    return {"type": "http", "headers": [(b"x-profile-token", token)]}
+
+
+def test_profile_token_check(monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_ADMIN_TOKEN", "admin-token")
+    monkeypatch.setattr(server, "PROFILE_SAMPLE_RATE", 0)
+    middleware = server.ProfilingMiddleware(app=None)
+
+    assert middleware.should_profile(scope_with_token(b"admin-token"))
+    assert not middleware.should_profile(scope_with_token(b"wrong"))
+    # Non-ASCII header values must be rejected, not raise
+    assert not middleware.should_profile(scope_with_token("\xe4dm".encode("latin-1")))
+    assert not middleware.should_profile({"type": "http", "headers": []})
+
+
+def test_only_newest_profiles_are_kept(monkeypatch, tmp_path):
+    monkeypatch.setattr(server, "PROFILE_DIR", tmp_path)
+    monkeypatch.setattr(server, "PROFILE_MAX_FILES", 2)
+
+    for i in range(4):
+        server.ProfilingMiddleware.save(f"profile-{i}", "{}")
+        os.utime(tmp_path / f"profile-{i}.speedscope.json", (i, i))
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "profile-2.speedscope.json",
+        "profile-3.speedscope.json",
+    ]
+
+
+def test_profiled_request_writes_speedscope_file(monkeypatch, tmp_path):
+    pytest.importorskip("pyinstrument")
+    monkeypatch.setattr(server, "PROFILE_ADMIN_TOKEN", "admin-token")
+    monkeypatch.setattr(server, "PROFILE_DIR", tmp_path)
+
+    async def app(scope, receive, send):
+        await asyncio.sleep(0.01)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    scope = {"type": "http", "method": "GET", "path": "/api/", **scope_with_token(b"admin-token")}
+    asyncio.run(server.ProfilingMiddleware(app)(scope, receive, send))
+
+    headers = dict(sent[0]["headers"])
+    profile_id = headers[b"x-profile-id"].decode()
+    profile = json.loads((tmp_path / f"{profile_id}.speedscope.json").read_text())
+    assert "speedscope" in profile["$schema"]
+    assert sent[1]["body"] == b"ok"
@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+import server
+
+
+def list_chats(user):
+    return server.get_user_chats(archived=False, current_user=user)
+
+
+def test_concurrent_reads_share_one_query(db, user, chat_doc):
+    db.chats.docs.append(chat_doc("chat-1"))
+
+    async def scenario():
+        return await asyncio.gather(*(list_chats(user) for _ in range(5)))
+
+    responses = asyncio.run(scenario())
+    assert db.chats.calls.count("find") == 1
+    assert len({response.body for response in responses}) == 1
+    assert [chat["id"] for chat in json.loads(responses[0].body)] == ["chat-1"]
+    assert server.inflight_reads == {}
+
+
+def test_cancelled_caller_does_not_cancel_shared_read(db, user, chat_doc):
+    db.chats.docs.append(chat_doc("chat-1"))
+    db.chats.read_gate = gate = asyncio.Event()
+
+    async def scenario():
+        first = asyncio.create_task(list_chats(user))
+        second = asyncio.create_task(list_chats(user))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0)
+        gate.set()
+        return first, await second
+
+    first, response = asyncio.run(scenario())
+    assert first.cancelled()
+    assert [chat["id"] for chat in json.loads(response.body)] == ["chat-1"]
+    assert db.chats.calls.count("find") == 1
+
+
+def test_read_after_own_write_does_not_join_stale_query(db, user):
+    db.chats.read_gate = gate = asyncio.Event()
+
+    async def scenario():
+        stale = asyncio.create_task(list_chats(user))
+        await asyncio.sleep(0.01)
+        db.chats.read_gate = None
+        await server.create_chat(server.ChatCreate(title="Neu"), current_user=user, idempotency_key=None)
+        # Joining the stale read would block on the gate until the timeout
+        fresh = await asyncio.wait_for(list_chats(user), timeout=1)
+        gate.set()
+        return await stale, fresh
+
+    stale, fresh = asyncio.run(scenario())
+    assert json.loads(stale.body) == []
+    assert [chat["title"] for chat in json.loads(fresh.body)] == ["Neu"]
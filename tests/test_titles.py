@@ -0,0 +1,81 @@
+import asyncio
+
+import server
+
+
+def add_message(user, chat_id, role, content):
+    return server.add_message_to_chat(
+        chat_id, server.MessageAdd(role=role, content=content), current_user=user, idempotency_key=None
+    )
+
+
+def create_chat(user):
+    return server.create_chat(server.ChatCreate(), current_user=user, idempotency_key=None)
+
+
+def test_user_title_is_not_overwritten(db, user):
+    async def scenario():
+        chat = await create_chat(user)
+        await server.update_chat(chat.id, server.ChatUpdate(title="Mein Titel"), current_user=user)
+        await add_message(user, chat.id, "user", "Hallo Welt. Wie geht's?")
+        await add_message(user, chat.id, "assistant", "Gut, danke!")
+        return await server.get_chat(chat.id, current_user=user)
+
+    assert asyncio.run(scenario()).title == "Mein Titel"
+
+
+def test_heuristic_title_without_workers(db, user):
+    async def scenario():
+        chat = await create_chat(user)
+        await add_message(user, chat.id, "assistant", "Hallo! Ich bin Mr Ermin.")
+        await add_message(user, chat.id, "user", "Hallo Welt. Wie geht's?")
+        await add_message(user, chat.id, "assistant", "Gut, danke!")
+        return await server.get_chat(chat.id, current_user=user)
+
+    chat = asyncio.run(scenario())
+    assert chat.title == "Hallo Welt"
+    assert chat.preview == "Gut, danke!"
+
+
+def test_existing_chat_is_titled_from_its_first_exchange(db, user, monkeypatch):
+    chat = server.Chat(user_id=user.id, title=server.DEFAULT_CHAT_TITLE, messages=[
+        server.ChatMessage(role="assistant", content="Hallo! Ich bin Mr Ermin."),
+        server.ChatMessage(role="user", content="Erste Frage."),
+        server.ChatMessage(role="assistant", content="Erste Antwort."),
+        server.ChatMessage(role="user", content="Zweite Frage."),
+    ])
+    db.chats.docs.append(chat.dict())
+
+    async def scenario():
+        generator = server.TitleGenerator(workers=1, batch_size=8, max_queued=10)
+        monkeypatch.setattr(server, "title_generator", generator)
+        generator.start()
+        await add_message(user, chat.id, "assistant", "Zweite Antwort.")
+        while generator.queued:
+            await asyncio.sleep(0.001)
+        await generator.close()
+        return await server.get_chat(chat.id, current_user=user)
+
+    titled = asyncio.run(scenario())
+    assert titled.title == "Erste Frage"
+    assert titled.preview == "Erste Antwort."
+
+
+def test_failed_inline_title_write_does_not_fail_the_message(db, user, monkeypatch):
+    async def fail(*args, **kwargs):
+        raise RuntimeError("mongo unavailable")
+
+    async def scenario():
+        chat = await create_chat(user)
+        await add_message(user, chat.id, "user", "Hallo Welt.")
+        monkeypatch.setattr(db.chats, "bulk_write", fail)
+        response = await server.add_message_to_chat(
+            chat.id, server.MessageAdd(role="assistant", content="Gut!"), current_user=user, idempotency_key="key-1"
+        )
+        return chat, response
+
+    chat, response = asyncio.run(scenario())
+    assert response == {"message": "Message added successfully"}
+    assert db.idempotency_keys.docs[0]["response"] == response
+    stored = next(doc for doc in db.chats.docs if doc["id"] == chat.id)
+    assert [m["content"] for m in stored["messages"]] == ["Hallo Welt.", "Gut!"]
@@ -0,0 +1,111 @@
+import asyncio
+
+from fastapi import HTTPException
+
+import server
+
+
+def message(content):
+    return server.ChatMessage(role="user", content=content).dict()
+
+
+def make_buffer(durable=True, flush_interval=0.005, batch_size=500, max_pending=100):
+    buffer = server.MessageWriteBuffer(
+        durable=durable, flush_interval=flush_interval, batch_size=batch_size, max_pending=max_pending
+    )
+    buffer.start()
+    return buffer
+
+
+def contents(db, chat_id):
+    chat = next(doc for doc in db.chats.docs if doc["id"] == chat_id)
+    return [m["content"] for m in chat.get("messages", [])]
+
+
+def test_appends_are_coalesced_into_one_bulk_write(db, user, chat_doc):
+    db.chats.docs += [chat_doc("chat-1"), chat_doc("chat-2")]
+
+    async def scenario():
+        buffer = make_buffer()
+        await asyncio.gather(
+            buffer.append(user.id, "chat-1", message("eins")),
+            buffer.append(user.id, "chat-2", message("zwei")),
+            buffer.append(user.id, "chat-1", message("drei")),
+        )
+        await buffer.close()
+
+    asyncio.run(scenario())
+    assert db.chats.calls.count("bulk_write") == 1
+    assert contents(db, "chat-1") == ["eins", "drei"]
+    assert contents(db, "chat-2") == ["zwei"]
+
+
+def test_failed_chat_only_fails_its_own_appends(db, user, chat_doc):
+    db.chats.docs += [chat_doc("chat-1"), chat_doc("chat-2")]
+    db.chats.fail_bulk_indexes = {1}  # the update for chat-2
+
+    async def scenario():
+        buffer = make_buffer()
+        results = await asyncio.gather(
+            buffer.append(user.id, "chat-1", message("eins")),
+            buffer.append(user.id, "chat-2", message("zwei")),
+            return_exceptions=True,
+        )
+        await buffer.close()
+        return results
+
+    ok, failed = asyncio.run(scenario())
+    assert ok is None
+    assert isinstance(failed, HTTPException) and failed.status_code == 503
+    assert contents(db, "chat-1") == ["eins"]
+    assert contents(db, "chat-2") == []
+
+
+def test_full_buffer_applies_backpressure(db, user, chat_doc):
+    db.chats.docs.append(chat_doc("chat-1"))
+
+    async def scenario():
+        buffer = make_buffer(durable=False, flush_interval=60, max_pending=2)
+        await buffer.append(user.id, "chat-1", message("eins"))
+        await buffer.append(user.id, "chat-1", message("zwei"))
+        third = asyncio.create_task(buffer.append(user.id, "chat-1", message("drei")))
+        await asyncio.sleep(0.01)
+        blocked = not third.done()
+        await buffer.flush()
+        await asyncio.wait_for(third, timeout=1)
+        await buffer.close()
+        return blocked
+
+    assert asyncio.run(scenario())
+    assert contents(db, "chat-1") == ["eins", "zwei", "drei"]
+
+
+def test_close_drains_buffered_messages(db, user, chat_doc):
+    db.chats.docs.append(chat_doc("chat-1"))
+
+    async def scenario():
+        buffer = make_buffer(durable=False, flush_interval=60)
+        await buffer.append(user.id, "chat-1", message("eins"))
+        assert contents(db, "chat-1") == []
+        await buffer.close()
+
+    asyncio.run(scenario())
+    assert contents(db, "chat-1") == ["eins"]
+
+
+def test_reads_include_buffered_messages(db, user, monkeypatch, chat_doc):
+    db.chats.docs.append(chat_doc("chat-1"))
+
+    async def scenario():
+        buffer = make_buffer(durable=False, flush_interval=60)
+        monkeypatch.setattr(server, "message_buffer", buffer)
+        await server.add_message_to_chat(
+            "chat-1", server.MessageAdd(role="user", content="eins"), current_user=user, idempotency_key=None
+        )
+        chat = await server.get_chat("chat-1", current_user=user)
+        await buffer.close()
+        return chat
+
+    chat = asyncio.run(scenario())
+    assert [m.content for m in chat.messages] == ["eins"]
+    assert contents(db, "chat-1") == ["eins"]